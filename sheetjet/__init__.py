@@ -1,5 +1,6 @@
 from .tg5012a import TG5012A
 from .gyger import VCMini
+from .gyger import ValveParameters
 from .mxii import MXII
 from .discovery import discover
 from .discovery import DeviceInfo
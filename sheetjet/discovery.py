@@ -1,7 +1,12 @@
-import serial.tools.list_ports as list_ports
-import configparser
+import dataclasses
+import functools
 import logging
+import os
 
+# Parsed configuration files, keyed by path. Each entry holds the
+# (st_mtime_ns, st_size, devices) of the file when it was parsed so
+# that repeated reads of an unchanged file only cost a stat() call.
+_CONFIG_CACHE = {}
 
 
 def discover(devices = ['VCMini', 'TG5012A', 'MXP7970', 'MXP9900'], config_file = 'sheetjet.ini', save_config = True, load_config = True):
@@ -58,16 +63,18 @@ def discover(devices = ['VCMini', 'TG5012A', 'MXP7970', 'MXP9900'], config_file
     return ret
 
 def discover_device(name):
+    import serial.tools.list_ports as list_ports
     print('Searching for %s' % (name))
     input('    Unplug the USB/Serial cable connected to %s. Press Enter when unplugged...' %(name))
     before = list_ports.comports()
     check_duplicate_ports(before)
     logging.debug('Devices found after unplugging:\n%s' %(format_devices_found(before)))
+    before = frozenset(p.device for p in before)
     input('    Reconnect the cable. Press Enter when the cable has been plugged in...')
     after = list_ports.comports()
     check_duplicate_ports(after)
     logging.debug('Devices found after replugging:\n%s' %(format_devices_found(after)))
-    port = [i for i in after if i not in before]
+    port = [i for i in after if i.device not in before]
     if(len(port) == 1):
         return DeviceInfo(port[0].device, port[0].hwid)
     elif(len(port) == 0):
@@ -84,40 +91,58 @@ def format_devices_found(comports):
     return ret
 
 def write_config(devices, config_file):
+    import configparser
     config = configparser.ConfigParser()
-    for d in devices:
-        config[d] = devices[d].__dict__
+    config.read_dict({d: devices[d].as_config() for d in devices})
     with open(config_file, 'w') as configfile:
         config.write(configfile)
+    _CONFIG_CACHE.pop(config_file, None)
 
 
 def read_config(config_file, check_against_ports = True):
-    config = configparser.ConfigParser()
+    """
+    Load the ``DeviceInfo`` of each device from config_file.
+
+    If check_against_ports is True, devices whose hwid is not found among
+    the serial ports are set to None.
+    """
     try:
-        config.read(config_file)
-    except:
-        logging.warning('Could not read config file %s' %(config_file))
+        st = os.stat(config_file)
+    except OSError:
         return None
-    if(config.sections() == []):
+    cached = _CONFIG_CACHE.get(config_file)
+    if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+        devices = cached[2]
+    else:
+        import configparser
+        config = configparser.ConfigParser()
+        try:
+            config.read(config_file)
+        except (OSError, configparser.Error) as e:
+            logging.warning('Could not read config file %s: %s', config_file, e)
+            return None
+        devices = {d: DeviceInfo.from_config(config[d]) for d in config.sections()}
+        _CONFIG_CACHE[config_file] = (st.st_mtime_ns, st.st_size, devices)
+    if(devices == {}):
         # Got empty config
         return None
-    ret = {}
-    for d in config.sections():
-        ret[d] = DeviceInfo.from_config(config[d]) 
+    # Callers modify the returned dictionary, so never hand out the cached one
+    ret = dict(devices)
 
     if(check_against_ports is False):
         return ret
     
+    import serial.tools.list_ports as list_ports
     ports = list_ports.comports()
     check_duplicate_ports(ports)
+    ports_by_hwid = {p.hwid: p for p in ports}
     for d in ret.keys():
-        found = False
-        for p in ports:
-            if(p.hwid == ret[d].hwid):
-                logging.debug('Found %s with hwid %s at %s' %(d, p.hwid, p.device))
-                found = True
-                continue
-        if found == False:
+        if ret[d] is None:
+            continue
+        p = ports_by_hwid.get(ret[d].hwid)
+        if p is not None:
+            logging.debug('Found %s with hwid %s at %s' %(d, p.hwid, p.device))
+        else:
             logging.warning('Could not find %s with hwid %s' %(d, ret[d].hwid))
             ret[d] = None
     return ret
@@ -133,6 +158,7 @@ def check_duplicate_ports(port_list):
 
 
 
+@dataclasses.dataclass(frozen=True)
 class DeviceInfo:
     """
     Stores basic information about a serial port and the hardware attached to it.
@@ -149,19 +175,37 @@ class DeviceInfo:
         Should help us to later identify if the same hardware is still plugged in.
     
     """
-    def __init__(self, device, hwid):
-        self.device = device
-        self.hwid = hwid
-    
+    __slots__ = ('device', 'hwid')
+    device: str
+    hwid: str
+
     @classmethod
     def from_config(cls, config):
         if all(k in config for k in ('device', 'hwid')):
-            return cls(config['device'], config['hwid'])
+            return _device_info(config['device'], config['hwid'])
         else:
             return None
-    
+
+    def as_config(self):
+        """Returns the attributes as a dictionary suitable for a config file section."""
+        return {'device': self.device, 'hwid': self.hwid}
+
+    def __getstate__(self):
+        return (self.device, self.hwid)
+
+    def __setstate__(self, state):
+        # Needed for copy and pickle, as frozen blocks the default setattr on the slots
+        object.__setattr__(self, 'device', state[0])
+        object.__setattr__(self, 'hwid', state[1])
+
     def __str__(self):
         return 'device=%s hwid=%s' % (self.device, self.hwid)
 
     def __repr__(self):
-        return 'DeviceInfo(device=%s, hwid=%s)' % (self.device, self.hwid)
\ No newline at end of file
+        return 'DeviceInfo(device=%s, hwid=%s)' % (self.device, self.hwid)
+
+
+@functools.lru_cache(maxsize=32)
+def _device_info(device, hwid):
+    # DeviceInfo is immutable, so identical config sections can share one instance
+    return DeviceInfo(device, hwid)
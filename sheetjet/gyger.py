@@ -1,7 +1,27 @@
-import serial
-from dataclasses import dataclass
-from typing import Tuple
+from dataclasses import dataclass, replace
+from types import MappingProxyType
 import logging
+import string
+import threading
+import time
+from .lowlatency import set_low_latency
+
+# Encoded form of the single character commands of the VC Mini
+_CMD = MappingProxyType({c: c.encode('ascii') for c in string.ascii_letters + '*='})
+
+@dataclass
+class ValveParameters:
+    """
+    Copy of the parameters of the active valve as stored in the VC Mini RAM.
+
+    Times are in us and peak_current is the raw parameter D (see ``VCMini.peak_current``).
+    """
+    __slots__ = ('peak_time', 'open_time', 'cycle_time', 'peak_current', 'num_shots')
+    peak_time: int
+    open_time: int
+    cycle_time: int
+    peak_current: int
+    num_shots: int
 
 class VCMini:
     """
@@ -9,6 +29,30 @@ class VCMini:
 
     Based on the "Manual serial interface VC Mini rev 2.00 en" found at https://www.fgyger.ch/downloads/?lang=en   
     """
+    # Every reply ends with a newline followed by the '\r>' prompt
+    _TERM = b'>'
+    _NL = b'\n'
+    _PROMPT = b'\r>'
+
+    # Command bytes for trigger_mode() and fire()
+    _TRIGGER_CMDS = MappingProxyType({'single': b'X', 'pulse': b'T', 'series': b'P', 'pulse series': b'L', 'stop': b'S'})
+    _FIRE_CMDS = MappingProxyType({'v1': b'Y', 'v2': b'Z', 'both': b'V', 'series v1': b'Q', 'series v2': b'R', 'series both': b'U', 'stop': b'S'})
+
+    # Echo that starts the reply to each of the query commands
+    _QUERY_PREFIX = MappingProxyType({c: b'.' + c.encode('ascii') for c in 'abcdgpquvwxyz='})
+
+    # Query and set commands of each of the ValveParameters fields
+    _PARAMETERS = {'peak_time': ('a', 'A'), 'open_time': ('b', 'B'), 'cycle_time': ('c', 'C'),
+                   'peak_current': ('d', 'D'), 'num_shots': ('g', 'G')}
+    # Allowed range of each of the ValveParameters fields, and the error raised outside of it
+    _LIMITS = MappingProxyType({'peak_time': (100, 500, "Peak time must be between 100 and 500 us"),
+                                'open_time': (400, 9999999, "Open time must be between 400 and 9999999 us"),
+                                'cycle_time': (10, 9999999, "Cycle time must be between 10 and 9999999 us"),
+                                'peak_current': (0, 15, "Peak current must be between 0 and 15"),
+                                'num_shots': (0, 65535, "Number of shots must be between 0 and 65535")})
+    # ValveParameters field changed by each parametrization command
+    _RAM_FIELDS = MappingProxyType({set_cmd: name for name, (_, set_cmd) in _PARAMETERS.items()})
+
     def __init__(self, serial_port = 'COM6', baudrate=38400, timeout_s=1):
         """
         Open communication with valve controller VC-Mini
@@ -16,6 +60,8 @@ class VCMini:
         Also sets the module address to 0, active parameter set to 0 and 
         reads the current parameters loaded.
         """
+        # Imported here so that ValveParameters can be used without pyserial
+        import serial
         ser = serial.Serial()
         ser.baudrate = baudrate
         ser.port = serial_port
@@ -24,19 +70,31 @@ class VCMini:
         ser.stopbits = serial.STOPBITS_ONE
         ser.timeout = timeout_s # seconds
         ser.open()
-        if(ser.is_open != True):
-            raise ConnectionError("Serial port failed to open")
+        set_low_latency(ser)
         self.ser = ser
+        # Bytes received but not yet returned by _read_until_prompt
+        self._rx = bytearray()
+        # EEPROM position of the loaded parameter set, None until it is queried
+        self._position = None
+        # EEPROM position known to hold the same parameters as the RAM, if any
+        self._saved_position = None
+        # Held for each command and its reply, reentrant so that nested calls don't deadlock
+        self._io_lock = threading.RLock()
         try:
-            # In case the controller is in trigger mode first stop it
-            self.trigger_mode('stop')
+            # In case the controller is in trigger mode first stop it.
+            # The stop is sent in the same write as the RAM queries.
+            stop = self._TRIGGER_CMDS['stop']
+            self.ser.write(stop + b'abcdg')
+            ret = self._read_until_prompt()
+            self.ram = ValveParameters(*self._reap_queries('abcdg'))
+            self._check_echo(stop, ret)
         except:
             self.close()
             raise
-        logging.info("Successfully connected to VCMIni on %s" % (serial_port))
+        logging.info("Successfully connected to VCMIni on %s", serial_port)
 
     def __str__(self):
-        """Show all the parameters of the valve controller."""
+        """Show all the parameters of the valve controller, using the last known values of the RAM parameters."""
         return "VC-Mini on %s, active valve: %s\n" \
             "  EEPROM address/parameter set: %d/%d\n" \
             "  Peak time: %10s us\n" \
@@ -60,51 +118,97 @@ class VCMini:
     def reopen(self):
         """Reopen the serial connection."""
         self.ser.open()
-        if(self.ser.is_open != True):
-            raise ConnectionError("Serial port failed to open")
-        self.init_ram()
-        logging.info("Successfully connected to VCMIni on %s" % (self.ser.port))
+        set_low_latency(self.ser)
+        self._rx.clear()
+        self.invalidate_cache()
+        logging.info("Successfully connected to VCMIni on %s", self.ser.port)
 
 
-    def peak_time(self, set = None, valve = 'both', override_limits = False):
-        """Query or set peak current time to initiate valve opening, in us."""
-        if(set is None):
-            return self.query('a')
-        else:
-            if(set < 100 or set  > 500) and not override_limits:
-                raise ValueError("Peak time must be between 100 and 500 us")
-            self.ram.peak_time = set
-            return self.set_parameter('A', set)
+    def init_ram(self):
+        """Read the parameters of the active valve from the controller into ``self.ram``."""
+        self.ram = ValveParameters(*self._pipeline_query('abcdg'))
 
-    def open_time(self, set = None, override_limits = False):
-        """Query or set valve open time in us."""
-        if(set is None):
-            return self.query('b')
-        else:
-            if (set < 400 or set > 9999999) and not override_limits:
-                raise ValueError("Open time must be between 400 and 9999999 us")
-            self.set_parameter('B', set)
+    def invalidate_cache(self):
+        """
+        Forget the cached parameter set position and read the RAM parameters again.
+
+        Use it when the controller might have been changed by something else than
+        this object, e.g. from the front panel or by a power cycle.
+        """
+        with self._io_lock:
+            self._position = None
+            self._saved_position = None
+            self.init_ram()
+
+    def invalidate(self, position = None):
+        """
+        Forget that the EEPROM position holds the parameters in the RAM, so that the
+        next save to it is written even if the parameters were not changed.
+        If position is None this is done for whichever position was known to match.
+        """
+        if position is None or position == self._saved_position:
+            self._saved_position = None
+
+    def _parameter(self, name, set, refresh = False, override_limits = False, force = False):
+        """
+        Query or set the ValveParameters field name using the commands in ``_PARAMETERS``.
 
-    def cycle_time(self, set = None):
-        """Query or set firing frequency in us."""
+        If refresh is True the value is first read from the controller into ``self.ram``,
+        otherwise the last known copy in it is used. Setting the value already in
+        ``self.ram`` is skipped, unless force is True.
+        Values outside of ``_LIMITS`` are rejected, unless override_limits is True.
+        """
+        query_cmd, set_cmd = self._PARAMETERS[name]
         if(set is None):
-            return self.query('c')
-        else:
-            if set < 10 or set > 9999999:
-                raise ValueError("Cycle time must be between 10 and 9999999 us")
-            return self.set_parameter('C', set)
+            if refresh:
+                setattr(self.ram, name, self.query(query_cmd))
+            return getattr(self.ram, name)
+        if(not isinstance(set, int)):
+            # Checked before comparing with the RAM copy, where 300.0 == 300
+            raise ValueError("Value must be an integer")
+        low, high, error = self._LIMITS[name]
+        if(not low <= set <= high and not override_limits):
+            raise ValueError(error)
+        if refresh:
+            setattr(self.ram, name, self.query(query_cmd))
+        if(not force and set == getattr(self.ram, name)):
+            # Already set, skip the round-trip to the controller
+            return set
+        return self.set_parameter(set_cmd, set)
+
+    def peak_time(self, set = None, valve = 'both', override_limits = False, refresh = False, force = False):
+        """
+        Query or set peak current time to initiate valve opening, in us.
+        Queries use the last known value unless refresh is True, and setting it again is skipped unless force is True.
+        """
+        return self._parameter('peak_time', set, refresh, override_limits, force)
+
+    def open_time(self, set = None, override_limits = False, refresh = False, force = False):
+        """
+        Query or set valve open time in us.
+        Queries use the last known value unless refresh is True, and setting it again is skipped unless force is True.
+        """
+        return self._parameter('open_time', set, refresh, override_limits, force)
+
+    def cycle_time(self, set = None, refresh = False, force = False):
+        """
+        Query or set firing frequency in us.
+        Queries use the last known value unless refresh is True, and setting it again is skipped unless force is True.
+        """
+        return self._parameter('cycle_time', set, refresh, force = force)
     
-    def peak_current(self, set = None, raw = False):
+    def peak_current(self, set = None, raw = False, refresh = False, force = False):
         """
         Query or set peak current.
         If raw is True the function takes a returns directly the parameter D as stated in the manual.
         The actual peak current I_p is given by I_p = 450mA + (D * 50mA). 
         If raw is False the function accepts and returns values in Amperes.
         Should be kept at 1 A (meaning value 11).
+        Queries use the last known value unless refresh is True, and setting it again is skipped unless force is True.
         """
 
         if(set is None):
-            ret = self.query('d')
+            ret = self._parameter('peak_current', None, refresh)
             if raw:
                 return ret
             else:
@@ -112,24 +216,74 @@ class VCMini:
         else:
             if raw is False:
                 set = round((set - 0.45)/0.05)
-            if set < 0 or set > 15:
-                raise ValueError("Peak current must be between 0 and 15")
-            return self.set_parameter('D', set)
+            return self._parameter('peak_current', set, refresh, force = force)
         
-    def num_shots(self, set = None):
-        """Query or set number of shots to fire before stopping. 0 means infinite."""
-        if(set is None):
-            return self.query('g')
-        else:
-            if set < 0 or set > 65535:
-                raise ValueError("Number of shots must be between 0 and 65535")
-            return self.set_parameter('G', set)            
+    def num_shots(self, set = None, refresh = False, force = False):
+        """
+        Query or set number of shots to fire before stopping. 0 means infinite.
+        Queries use the last known value unless refresh is True, and setting it again is skipped unless force is True.
+        """
+        return self._parameter('num_shots', set, refresh, force = force)
+
+    def set_parameters(self, params, override_limits = False):
+        """
+        Set all the parameters of the active valve from the ValveParameters params.
+
+        Only the values that differ from ``self.ram`` are sent, all in a single
+        write, and their echoes are checked afterwards. Values outside of the
+        allowed ranges are rejected before anything is sent, unless override_limits is True.
+        Returns ``self.ram``.
+
+        All the echoes are read, and ``self.ram`` updated for each command the controller
+        acknowledged, before raising the first error found.
+        """
+        cmds = []
+        for name, (_, set_cmd) in self._PARAMETERS.items():
+            value = getattr(params, name)
+            if(not isinstance(value, int)):
+                raise ValueError("Value must be an integer")
+            low, high, error = self._LIMITS[name]
+            if(not low <= value <= high and not override_limits):
+                raise ValueError(error)
+            if(value != getattr(self.ram, name)):
+                cmds.append((name, value, b'%d%s' % (value, _CMD[set_cmd])))
+        if not cmds:
+            return self.ram
+        with self._io_lock:
+            self.ser.write(b''.join(cmd for _, _, cmd in cmds))
+            # The RAM no longer matches what is stored in the EEPROM
+            self._saved_position = None
+            error = None
+            for name, value, cmd in cmds:
+                ret = self._read_until_prompt()
+                try:
+                    if not self._check_echo(cmd, ret):
+                        # Ignored by a busy controller
+                        continue
+                except Exception as e:
+                    if error is None:
+                        error = e
+                    continue
+                setattr(self.ram, name, value)
+            if error is not None:
+                raise error
+        return self.ram
 
     def valve_status(self):
         """Returns the active status for each of the two valves as a tuple."""
         v = self.query('q')
         return (v & 0x10, v & 0x01)
     
+    def status_snapshot(self):
+        """
+        Returns the valve_status() of both valves followed by both shot counters, as a tuple.
+
+        The three queries are sent in a single write, so this is cheaper than
+        calling valve_status() and shot_counter() separately when monitoring.
+        """
+        status, shots_0, shots_1 = self._pipeline_query('qyz')
+        return (status & 0x10, status & 0x01, shots_0, shots_1)
+
     def shot_counter(self, valve):
         """Returns the shot counter for the specified valve.
         
@@ -154,17 +308,15 @@ class VCMini:
     def total_shot_counter(self, valve):
         """Returns the total shot counter for the specified valve."""
         if valve == 0:
-            high = self.query('u')
-            low = self.query('v')
+            high, low = self._pipeline_query('uv')
             return (high<<24) | low
         elif valve == 1:
-            high = self.query('w')
-            low = self.query('x')
+            high, low = self._pipeline_query('wx')
             return (high<<24) | low
         else:
             raise ValueError("Invalid valve number")
         
-    def active_valve(self, valve = None, param_set = 0, save_on_change = True):
+    def active_valve(self, valve = None, param_set = 0, save_on_change = True, refresh = False):
         """
         Query or set the active valve. Changes to most parameters only affect the active valve.
         valve can be None, v1 or v2. If it is None, the current active valve is returned.
@@ -172,9 +324,10 @@ class VCMini:
         param_set is a number from 0-3 that defines what parameter set is loaded from the controller.
         save_on_change is a boolean that defines if the current parameters should be saved to the EEPROM before changing the active valve.
         If they are not saved, any changes made to the parameters of the previously active valve will be lost.
+        Queries use the last known parameter set unless refresh is True.
         """
         if(valve is None):
-            cur_param_set = int(self._load_parameters())
+            cur_param_set = int(self._load_parameters(refresh = refresh))
             if cur_param_set >= 0 and cur_param_set < 4:
                 return 'v1'
             elif cur_param_set >= 4 and cur_param_set < 8:
@@ -215,31 +368,77 @@ class VCMini:
             return addr, module_type
             
 
-    def _load_parameters(self, position = None):
+    def _load_parameters(self, position = None, refresh = False):
         """
         Loads the a parameter set from the given EEPROM position.
-        If position is `None` return the current parameters position.
+        If position is `None` return the current parameters position,
+        using the last known one unless refresh is True.
         """
         if(position is None):
-            return self.query('p')
+            if refresh or self._position is None:
+                self._position = self.query('p')
+            return self._position
         else:
             if position < 0 or position > 7:
                 raise ValueError("Parameter position must be between 0 and 7")
-            ret =  self.query('n', position)
-            return ret
+            if position == self._position and position == self._saved_position:
+                # Already loaded and unchanged, loading it again would not change the RAM
+                return position
+            # The RAM now holds the newly loaded parameter set, so read it back
+            # in the same write as the load command
+            with self._io_lock:
+                # Until the load is confirmed it is not known which set the RAM holds
+                self._position = None
+                self._saved_position = None
+                self.ser.write(b'%dnabcdg' % (position))
+                ret = self._read_until_prompt()
+                # The RAM is read back even if the load failed, it is then still the previous set
+                self.ram = ValveParameters(*self._reap_queries('abcdg'))
+                self._parse_query_reply('n', b'%d.n' % (position), ret)
+                self._position = position
+                self._saved_position = position
+            return position
 
     def _save_parameters(self, position = None):
         """
         Saves the active set of parameters to the given EEPROM position.
         If position is `None` return the current parameters position.
+        Saving is skipped if the parameters were not changed since they were
+        loaded from, or saved to, that position.
         """
         if(position is None):
-            return self.query('p')
+            return self._load_parameters()
         else:
             if position < 0 or position > 7:
                 raise ValueError("Parameter position must be between 0 and 7")
+            if position == self._saved_position:
+                # Spare the EEPROM a write of the same values
+                return position
             return self.set_parameter('N', position)
             
+    def parameter_sets(self):
+        """
+        Returns the 8 parameter sets stored in the EEPROM as a tuple of ValveParameters.
+
+        Each set is loaded and read back in a single write. At the end, even if
+        reading a set failed, the set that was active is loaded again and any
+        changes to its parameters that were not saved are sent back to the controller.
+        """
+        with self._io_lock:
+            position = self._load_parameters()
+            ram = replace(self.ram)
+            sets = []
+            try:
+                for p in range(8):
+                    self._load_parameters(position = p)
+                    # A copy, as self.ram keeps following the controller
+                    sets.append(replace(self.ram))
+            finally:
+                # Also when a load failed, don't leave the controller on another set
+                self._load_parameters(position = position)
+                self.set_parameters(ram, override_limits = True)
+        return tuple(sets)
+
     def trigger_mode(self, mode='stop'):
         """
         Set the trigger mode.
@@ -256,10 +455,10 @@ class VCMini:
             * 'pulse series' : Arm shot series on valves V1 and V2 which continues for as long as the external hardware trigger stays high
             * 'stop' : Exit external trigger mode and disarm all triggers
         """
-        cmd_dict = {'single': 'X', 'pulse': 'T', 'series': 'P', 'pulse series': 'L', 'stop': 'S'}
-        if mode not in cmd_dict:
+        cmd = self._TRIGGER_CMDS.get(mode)
+        if cmd is None:
             raise ValueError("Invalid trigger mode")
-        return self.execute(cmd_dict[mode])
+        return self.execute(cmd)
     
     def fire(self, shot='stop'):
         """
@@ -279,10 +478,10 @@ class VCMini:
             * 'series both' : Series of shots of both valves until until 'stop' is issued
             * 'stop' : Stop any series of shots
         """
-        cmd_dict = {'v1': 'Y', 'v2': 'Z', 'both': 'V', 'series v1': 'Q', 'series v2': 'R', 'series both': 'U', 'stop': 'S'}
-        if shot not in cmd_dict:
+        cmd = self._FIRE_CMDS.get(shot)
+        if cmd is None:
             raise ValueError("Invalid shot")
-        return self.execute(cmd_dict[shot])
+        return self.execute(cmd)
 
 
     
@@ -291,81 +490,188 @@ class VCMini:
         """
         Send an execution command to the controller.
         Execution commands are defined in the Gyger VC Mini manual.
+        param can be given either as str or as already encoded bytes.
         """
-        if len(param) != 1:
-            raise ValueError("Invalid parameter")
-        self.ser.write(param.encode('ascii'))
-        ret = self.ser.read_until('>').decode('ascii')
-        line = ret.split('\n')[0]
-        if(line != param):
-            if line == '?':
-                logging.warning('Valve is busy!')
-            else:            
-                raise Exception("Error reading %s. Got %s" % (param, ret))
-        prompt = ret.split('\n')[1]
-        if(prompt != '\r>'):
-            raise Exception("Error reading %s. Got %s" % (param, ret))
+        with self._io_lock:
+            cmd = param if isinstance(param, bytes) else _CMD.get(param)
+            if cmd is None or len(cmd) != 1:
+                raise ValueError("Invalid parameter")
+            self.ser.write(cmd)
+            self._check_echo(cmd, self._read_until_prompt())
 
-    def set_parameter(self, param, value):
+    def set_parameter(self, param, value, refresh = False):
         """
         Send a parametrization command to the controller.
         Parametrization commands are defined in the Gyger VC Mini manual.
+
+        The new value is also stored in ``self.ram``. If refresh is True all the
+        RAM parameters are read back from the controller instead.
+        Returns value, or None if the controller was busy and ignored the command.
         """
-        if len(param) != 1:
-            raise ValueError("Invalid parameter")
-        if(not isinstance(value, int)):
-            raise ValueError("Value must be an integer")
+        with self._io_lock:
+            param_bytes = _CMD.get(param)
+            if param_bytes is None:
+                raise ValueError("Invalid parameter")
+            if(not isinstance(value, int)):
+                raise ValueError("Value must be an integer")
         
-        self.ser.write(('%d%s' % (value,param)).encode('ascii'))
-        ret = self.ser.read_until('>').decode('ascii')
-        line = ret.split('\n')[0]
-
-        if(line != '%d%s' % (value,param)):
-            if line == '?':
-                logging.warning('Valve is busy!')
-            else:                
-                raise Exception("Error reading %s. Got %s" % (param, ret))
-        prompt = ret.split('\n')[1]
-        if(prompt != '\r>'):
-            raise Exception("Error reading %s. Got %s" % (param, ret))
-        value = int(line[-2])
-        return value
+            cmd = b'%d%s' % (value, param_bytes)
+            self.ser.write(cmd)
+            if not self._check_echo(cmd, self._read_until_prompt()):
+                # Not applied, so self.ram still holds the controller's value
+                return None
+            if param in self._RAM_FIELDS:
+                # The RAM no longer matches what is stored in the EEPROM
+                self._saved_position = None
+            elif param == 'N':
+                # Don't assume which position the controller reports after saving
+                self._position = None
+                self._saved_position = value
+            if param == '*':
+                # Now addressing another module, whose parameters are not known yet
+                self.invalidate_cache()
+            elif refresh:
+                self.init_ram()
+            elif param in self._RAM_FIELDS:
+                setattr(self.ram, self._RAM_FIELDS[param], value)
+            return value
                     
     def query(self, param, value=None):
         """
         Send a query command parameters to the controller.
         Query command parameters are defined in the Gyger VC Mini manual.
         """
-        if len(param) != 1:
-            raise ValueError("Invalid parameter")
-        if(value is None):
-            self.ser.write(param.encode('ascii'))
-            output = '.%s' % (param)
-        else:
-            if(not isinstance(value, int)):
-                raise ValueError("Value must be an integer")
-            if(param != 'n'):
-                raise ValueError("Value can only be set when param='n'")
-            self.ser.write(('%d%s' % (value,param)).encode('ascii'))
-            output = '%d.%s' % (value, param)
-        ret = self.ser.read_until('>').decode('ascii')
-        line = ret.split('\n')[0]
-
-        if(line[:len(output)] != output):
-            if line == '?':
+        with self._io_lock:
+            param_bytes = _CMD.get(param)
+            if param_bytes is None:
+                raise ValueError("Invalid parameter")
+            if(value is None):
+                self.ser.write(param_bytes)
+                output = self._QUERY_PREFIX.get(param) or b'.' + param_bytes
+            else:
+                if(not isinstance(value, int)):
+                    raise ValueError("Value must be an integer")
+                if(param != 'n'):
+                    raise ValueError("Value can only be set when param='n'")
+                # Loads another parameter set, so until it is confirmed the RAM contents are not known
+                self._position = None
+                self._saved_position = None
+                self.ser.write(b'%d%s' % (value, param_bytes))
+                output = b'%d.%s' % (value, param_bytes)
+            ret = self._read_until_prompt()
+            parsed = self._parse_query_reply(param, output, ret)
+            if(value is None):
+                value = parsed
+            else:
+                self._position = value
+                self._saved_position = value
+                self.init_ram()
+            return value
+
+    def _read_until_prompt(self):
+        """
+        Read one reply from the controller, up to and including the '>' prompt.
+
+        pyserial's read_until() reads one byte per call. Here everything the
+        port has already received is read at once, blocking only while nothing
+        is available, until the prompt arrives or the port timeout expires.
+        Bytes received after the prompt, e.g. the start of the reply to the
+        next pipelined command, are kept in ``self._rx`` for the next call.
+        """
+        rx = self._rx
+        end = rx.find(self._TERM)
+        if end < 0 and self.ser.timeout is not None:
+            deadline = time.monotonic() + self.ser.timeout
+        while end < 0:
+            data = self.ser.read(max(1, self.ser.in_waiting))
+            if not data:
+                # Timed out
+                break
+            rx += data
+            end = rx.find(self._TERM, len(rx) - len(data))
+            if end < 0 and self.ser.timeout is not None and time.monotonic() > deadline:
+                break
+        if end < 0:
+            end = len(rx) - 1
+        # Copy the reply out of the receive buffer once, without an intermediate bytearray
+        with memoryview(rx) as view:
+            ret = bytes(view[:end + 1])
+        del rx[:end + 1]
+        return ret
+
+    def _pipeline_query(self, params):
+        """
+        Send several query commands in a single write and return their values as a list.
+
+        The controller answers the commands in order, so all the replies can be
+        collected after a single USB transfer instead of one round-trip per query.
+        """
+        with self._io_lock:
+            self.ser.write(params.encode('ascii'))
+            return self._reap_queries(params)
+
+    def _reap_queries(self, params):
+        """
+        Read and parse the replies to the query commands in params, already sent to the controller.
+
+        All the replies are read before raising the first error found, so that none
+        of them is left behind to be mistaken for the reply to a later command.
+        """
+        values = []
+        error = None
+        for param in params:
+            ret = self._read_until_prompt()
+            output = self._QUERY_PREFIX.get(param) or b'.' + _CMD[param]
+            try:
+                values.append(self._parse_query_reply(param, output, ret))
+            except Exception as e:
+                values.append(None)
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+        return values
+
+    def _check_echo(self, cmd, ret):
+        """
+        Check that the reply to an execution or parametrization command echoes cmd.
+
+        Returns True if it does, or False if the controller was busy and ignored the command.
+        """
+        nl = ret.find(self._NL)
+        acknowledged = True
+        if(nl != len(cmd) or not ret.startswith(cmd)):
+            if nl == 1 and ret.startswith(b'?'):
                 logging.warning('Valve is busy!')
+                acknowledged = False
             else:
-                raise Exception("Error reading %s. Got %s" % (param, ret))
-        prompt = ret.split('\n')[1]
-        if(prompt != '\r>'):
+                raise Exception("Error reading %s. Got %s" % (cmd, ret))
+        if(not self._ends_with_prompt(ret, nl)):
+            raise Exception("Error reading %s. Got %s" % (cmd, ret))
+        return acknowledged
+
+    def _ends_with_prompt(self, ret, nl):
+        """Check that the prompt directly follows the newline found at index nl of ret."""
+        return nl >= 0 and len(ret) == nl + 1 + len(self._PROMPT) and ret.endswith(self._PROMPT)
+
+    def _parse_query_reply(self, param, output, ret):
+        """
+        Check that the reply to a query starts with output and return the value that follows.
+
+        Raises if the controller was busy, as it then doesn't return any value.
+        """
+        nl = ret.find(self._NL)
+
+        if(not ret.startswith(output)):
+            if nl == 1 and ret.startswith(b'?'):
+                raise Exception("Valve is busy, could not read %s" % (param))
+            raise Exception("Error reading %s. Got %s" % (param, ret))
+        if(not self._ends_with_prompt(ret, nl)):
             raise Exception("Error reading %s. Got %s" % (param, ret))
-        
-        if(value is None):
-            value = line[len(output):]
-            try:
-                # Some return values are not integers
-                value = int(value)
-            except ValueError:
-                pass
 
-        return value
\ No newline at end of file
+        # Only the value itself is copied out of the reply
+        value = ret[len(output):nl]
+        # Some return values are not integers, e.g. the module type of '='
+        if value.isdigit() or (value[:1] in (b'-', b'+') and value[1:].isdigit()):
+            return int(value)
+        return value.decode('ascii')
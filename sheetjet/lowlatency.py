@@ -0,0 +1,33 @@
+import logging
+import os
+
+def set_low_latency(ser):
+    """
+    Ask the OS to pass on bytes received by the serial port ser without delay.
+
+    USB serial adapters, like the FTDI ones, hold received data for up to their
+    latency timer (16 ms by default) before handing it to the OS, which dominates
+    the round-trip time of the short commands used by the instruments.
+
+    On Linux this sets the ASYNC_LOW_LATENCY flag of the port and lowers the
+    FTDI latency timer to 1 ms, if the current user is allowed to. On other
+    systems, or with adapters that don't support it, nothing is changed.
+    Under Windows the latency timer can be set in the Device Manager
+    (see the known issues in the documentation).
+    """
+    try:
+        ser.set_low_latency_mode(True)
+    except (AttributeError, NotImplementedError, OSError, ValueError) as e:
+        logging.debug('Could not set low latency mode on %s: %s', ser.port, e)
+
+    if ser.port is None:
+        return
+    tty = os.path.basename(os.path.realpath(ser.port))
+    latency_timer = '/sys/bus/usb-serial/devices/%s/latency_timer' % (tty)
+    if not os.path.exists(latency_timer):
+        return
+    try:
+        with open(latency_timer, 'w') as f:
+            f.write('1')
+    except OSError as e:
+        logging.debug('Could not set the latency timer of %s: %s', ser.port, e)
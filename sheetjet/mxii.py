@@ -1,5 +1,6 @@
 import logging
-import serial
+import threading
+from .lowlatency import set_low_latency
 
 class MXII:
     """
@@ -10,11 +11,16 @@ class MXII:
     """
     def __init__(self, serial_port = None, baudrate = 19200, timeout_s = 1):
         # Open communication with valve controller VC-Mini
+        import serial
         ser = serial.Serial(port = serial_port, baudrate = baudrate, timeout = timeout_s)      
-        if(ser.is_open != True):
+        if not ser.is_open:
+            # pyserial only opens the port if one is given
             raise ConnectionError("Serial port failed to open")
+        set_low_latency(ser)
         self.ser = ser
-        self.terminator = '\r'
+        self.terminator = b'\r'
+        # Held for each command and its reply
+        self._io_lock = threading.RLock()
         # Test one command
         try:
             self.mode()
@@ -32,8 +38,7 @@ class MXII:
     def reopen(self):
         """Reopen the serial connection."""
         self.ser.open()
-        if(self.ser.is_open != True):
-            raise ConnectionError("Serial port failed to open")
+        set_low_latency(self.ser)
         # Test one command
         self.mode()
         logging.info("Successfully connected to MX II on %s" % (self.ser.port))
@@ -42,33 +47,36 @@ class MXII:
         """Queries or sets the active port"""
         if(port is None):
             # The valve returns the port number in hex
-            ret = int(self.query("S"), 16)
+            ret = int(self.query(b"S"), 16)
             if ret > 16:
                 logging.warning("valve failure error %d" % (ret))
             return ret
         if(port < 1 or port > 16):
             raise ValueError("Port must be between 1 and 16")
-        return self.write("P%02X" % (port))
+        return self.write(b"P%02X" % (port))
     
     def home(self):
         """Homes the valve"""
-        return self.write("M00")
+        return self.write(b"M00")
     
     def mode(self, set=None):
         if(set is None):
-            ret = int(self.query("D00"), 16)
+            ret = int(self.query(b"D00"), 16)
             return ret
         else:
             raise NotImplementedError("Setting the mode is not implemented yet")
     
     def query(self, cmd):
         """Queries the valve controller"""
-        self.write(cmd)
-        return self.ser.read_until(self.terminator).decode('ascii').strip()
+        with self._io_lock:
+            self.write(cmd)
+            return self.ser.read_until(self.terminator).decode('ascii').strip()
 
     def write(self, cmd):
-        """Writes a command to the valve controller"""
-        return self.ser.write((cmd + self.terminator).encode('ascii'))
+        """Writes a command, given as str or bytes, to the valve controller"""
+        if isinstance(cmd, str):
+            cmd = cmd.encode('ascii')
+        return self.ser.write(cmd + self.terminator)
     
 
     
@@ -1,8 +1,9 @@
 
 
 import socket
-import serial
 import logging
+import threading
+from .lowlatency import set_low_latency
 
 class TG5012A:
     """
@@ -14,19 +15,30 @@ class TG5012A:
     def __init__(self, serial_port = None, address='t539639.local', port=9221, auto_local=True, error_check=True):
         """Connects to a TF5012A function generator using the given serial_port or LAN address and port
         
-        If auto_local is true (default), the instrument will be set to local mode after each command.
+        If auto_local is true (default), the instrument will be set back to local mode by flush(),
+        close() or at the end of a with block, if any command was sent since it was last in local mode.
+        If auto_local is 'eager', the instrument will be set to local mode after each command.
         if error_check is true (default), the instrument will check for errors after each command.
         """
         self.terminator = b'\n'
+        # Bytes received from the instrument that are not yet returned by read()
+        self._rx = bytearray()
+        # Scratch buffer for socket.recv_into()
+        self._recv_buf = bytearray(1024)
+        self._recv_view = memoryview(self._recv_buf)
+        # Held for each command up to its error check, reentrant as query() and set() call each other
+        self._io_lock = threading.RLock()
         self.ser = None
         self.sock = None
         self.auto_local = auto_local
+        self._local_pending = False
         self.error_check = error_check
         if serial_port is not None:
             # Prefer serial over LAN communication        
+            # pyserial is only imported when needed, so LAN only use doesn't load it
+            import serial
             ser = serial.Serial(port = serial_port)
-            if(ser.is_open != True):
-                raise ConnectionError("Serial port failed to open")
+            set_low_latency(ser)
             try:
                 self.ser = ser
                 logging.info(self.id())
@@ -37,6 +49,9 @@ class TG5012A:
         else:
             # Open LAN connection
             self.sock = socket.socket()
+            # Send each command right away instead of waiting to coalesce small packets
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
             self.sock.connect((address, port))
             try:
                 logging.info(self.id())
@@ -46,30 +61,59 @@ class TG5012A:
                 raise
         
     def close(self):
-        """Close the serial connection."""
-        self.ser.close()
+        """Close the connection, setting the instrument back to local mode if needed."""
+        try:
+            self.flush()
+        finally:
+            # Closed even if the instrument could not be set back to local mode
+            if self.sock:
+                self.sock.close()
+            else:
+                self.ser.close()
+
+    def flush(self):
+        """Sets the instrument to local mode if a command was sent since it was last in local mode"""
+        with self._io_lock:
+            if self._local_pending:
+                self.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        try:
+            self.close()
+        except Exception as e:
+            # Don't hide the exception that is already being raised
+            logging.warning("Could not set TG5012A back to local mode: %s", e)
 
     def reopen(self):
         """Reopen the serial connection."""
         self.ser.open()
-        if(self.ser.is_open != True):
-            raise ConnectionError("Serial port failed to open")
+        set_low_latency(self.ser)
+        self._rx.clear()
         logging.info("Successfully connected to %s" % (self.ser.port))
         logging.info(self.id())  
 
     # Convenience functions
     def pulse(self, freq=1, width=0.1, rise = 0.001, fall = 0.001, high=1, low=0, delay = 0, phase=0, output = "ON"):
         """Sets the output to a pulse with the given parameters"""
-        self.wave("PULSE")
-        self.frequency(freq)
-        self.pulse_width(width)
-        self.pulse_rise(rise)
-        self.pulse_fall(fall)
-        self.pulse_delay(delay)
-        self.high(high)
-        self.low(low)
-        self.phase(phase)
-        self.output(output)
+        valid = ["ON", "OFF", "NORMAL", "INVERT"]
+        if output not in valid:
+            raise ValueError("Invalid output. It should be one of %s" % (valid))
+        return self._batch("WAVE PULSE",
+                           "FREQ %s" % (freq),
+                           "PULSWID %s" % (width),
+                           "PULSRISE %s" % (rise),
+                           "PULSFALL %s" % (fall),
+                           "PULSDLY %s" % (delay),
+                           "HILVL %s" % (high),
+                           "LOLVL %s" % (low),
+                           "PHASE %s" % (phase),
+                           "OUTPUT %s" % (output))
 
     
     # Channel Selection
@@ -325,49 +369,104 @@ class TG5012A:
     
     def local(self):
         """Sets the instrument to local mode"""
+        self._local_pending = False
         return self.set("LOCAL")    
 
     def query(self, cmd):
-        self.write(cmd)
-        ret = self.read()
-        if cmd != "QER?" and cmd != "EER?" and self.error_check:
-            err = self.query_error()
-            if int(err) != 0:
-                raise ValueError("Instrument returned query error %s" % (err))        
-        if(self.auto_local and cmd != "LOCAL" and cmd != "QER?" and cmd != "EER?"):
-            self.local()
-        return ret
-    
+        with self._io_lock:
+            if cmd != "QER?" and cmd != "EER?" and self.error_check:
+                # Send the error query in the same write and read both replies
+                self.write(cmd + '\n' + "QER?")
+                ret = self.read()
+                err = self.read()
+                if int(err) != 0:
+                    raise ValueError("Instrument returned query error %s" % (err))
+            else:
+                self.write(cmd)
+                ret = self.read()
+            if(cmd != "LOCAL" and cmd != "QER?" and cmd != "EER?"):
+                self._auto_local()
+            return ret
+
+    def query_many(self, cmds):
+        """Send several queries in a single write and return their replies as a list"""
+        with self._io_lock:
+            msg = '\n'.join(cmds)
+            if self.error_check:
+                # One error query covers all of them
+                msg += '\n' + "QER?"
+            self.write(msg)
+            ret = [self.read() for _ in cmds]
+            if self.error_check:
+                err = self.read()
+                if int(err) != 0:
+                    raise ValueError("Instrument returned query error %s" % (err))
+            self._auto_local()
+            return ret
+
     def set(self, cmd, value=None):
-        if(value is None):
-            ret = self.write(cmd)
-        else:
-            ret = self.write(cmd + ' ' + str(value))
-        if self.error_check:
-            err = self.execution_error()
-            if int(err) != 0:
-                raise ValueError("Instrument returned execution error %s" % (err))
-        if(self.auto_local and cmd != "LOCAL"):
-            self.local()
+        with self._io_lock:
+            if(value is None):
+                msg = cmd
+            else:
+                msg = cmd + ' ' + str(value)
+            if self.error_check:
+                # Send the error query in the same write
+                ret = self.write(msg + '\n' + "EER?")
+                err = self.read()
+                if int(err) != 0:
+                    raise ValueError("Instrument returned execution error %s" % (err))
+            else:
+                ret = self.write(msg)
+            if(cmd != "LOCAL"):
+                self._auto_local()
                     
-        return ret
+            return ret
     
-    def write(self, str):
-        """Write str to the instrument encoded as ascii as terminated"""
-        bytes = str.encode('ascii') + self.terminator
+    def _batch(self, *cmds):
+        """Send several commands as one message, separated by ';', checking for errors only once at the end"""
+        return self.set(';'.join(cmds))
+
+    def _auto_local(self):
+        """Sets the instrument to local mode after a command, now or on flush(), depending on auto_local"""
+        if self.auto_local == 'eager':
+            self.local()
+        elif self.auto_local:
+            self._local_pending = True
+
+    def write(self, cmd):
+        """Write cmd to the instrument encoded as ascii as terminated"""
+        payload = cmd.encode('ascii') + self.terminator
         if self.sock:
-            return self.sock.send(bytes)
+            # send() may only take part of a long batched message
+            self.sock.sendall(payload)
+            return len(payload)
         elif self.ser:
-            return self.ser.write(bytes)
+            return self.ser.write(payload)
         else:
             raise ConnectionError("No connection to instrument")
         
     def read(self):
         """Read line from the instrument"""
-        if self.sock:
-            recv = self.sock.recv(1024)
-            return recv.decode('ascii').strip()
-        elif self.ser:
-            return self.ser.readline().decode('ascii').strip()
-        else:
-            raise ConnectionError("No connection to instrument")        
\ No newline at end of file
+        if not self.sock and not self.ser:
+            raise ConnectionError("No connection to instrument")
+        # A reply can arrive split over several TCP segments or serial reads
+        rx = self._rx
+        end = rx.find(self.terminator)
+        while end < 0:
+            if self.sock:
+                # Receive into a reused buffer instead of a new bytes object per recv()
+                n = self.sock.recv_into(self._recv_buf)
+                recv = self._recv_view[:n]
+            else:
+                # Take everything received so far, only waiting while nothing has arrived
+                recv = self.ser.read(max(1, self.ser.in_waiting))
+            if not recv:
+                raise ConnectionError("No reply from instrument")
+            rx += recv
+            end = rx.find(self.terminator)
+        # Decode the line straight out of the receive buffer
+        with memoryview(rx) as view:
+            line = str(view[:end], 'ascii')
+        del rx[:end + len(self.terminator)]
+        return line.strip()